@@ -21,13 +21,111 @@
 #
 
 import sys, os, sqlite3, hashlib, argparse
+import concurrent.futures
+import urllib.parse
 
-def hash_file(filepath, bufsize=128 * 1024):
-	h = hashlib.md5()
-	buffer = bytearray(bufsize)
+try:
+	import blake3
+except ImportError:
+	blake3 = None
+
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+
+# databases created before the hash algorithm was stored in the config table
+# always used md5
+default_hash_algo = "md5"
+hash_algos = ["md5", "blake3", "xxh3"]
+
+# version 1 partial hashes only contain the first chunk of a file as older
+# versions tried to seek to the last chunk but actually seeked past the end of
+# the file. Version 2 partial hashes contain the first and the last chunk.
+partial_hash_version = 2
+
+def hash_algo_available(algo):
+	if algo == "blake3":
+		return blake3 is not None
+	if algo == "xxh3":
+		return xxhash is not None
+	return algo == "md5"
+
+def new_hash(algo):
+	if algo == "blake3":
+		return blake3.blake3()
+	if algo == "xxh3":
+		return xxhash.xxh3_128()
+	return hashlib.md5()
+
+def get_config(cur, key):
+	res = cur.execute("SELECT value FROM config WHERE key == ?", (key,))
+	entry = res.fetchone()
+	if entry is None:
+		return None
+	return entry[0]
+
+# files sqlite creates next to a database
+db_suffixes = ["", "-wal", "-shm", "-journal"]
+
+def readonly_uri(dbpath):
+	return "file:" + urllib.parse.quote(os.path.abspath(dbpath)) + "?mode=ro"
+
+def connect_db(dbpath, readonly=False):
+	if readonly:
+		# the db may be on read-only media or belong to another user, so
+		# nothing is written, including the journal mode
+		lite = sqlite3.connect(readonly_uri(dbpath), uri=True)
+	else:
+		lite = sqlite3.connect(dbpath)
+	lite.row_factory = sqlite3.Row
+	
+	if not readonly:
+		# only has an effect on new databases and has to be set before WAL mode
+		lite.execute("PRAGMA page_size=8192")
+		lite.execute("PRAGMA journal_mode=WAL")
+		lite.execute("PRAGMA synchronous=NORMAL")
+	lite.execute("PRAGMA cache_size=-65536")
+	lite.execute("PRAGMA temp_store=MEMORY")
+	lite.execute("PRAGMA mmap_size=1073741824")
+	
+	return lite
+
+def close_dbs():
+	for cursor in cursors.values():
+		cursor.close()
+	
+	for db in dbs.values():
+		# WAL mode is only used while updating. A db left in WAL mode cannot
+		# be read from read-only media and WAL does not work on network
+		# filesystems. Changes of an aborted update are discarded first as
+		# the mode cannot be changed inside a transaction. Switching fails
+		# while another connection to the same db is open, in that case the
+		# last connection switches the mode.
+		db.rollback()
+		try:
+			db.execute("PRAGMA journal_mode=DELETE")
+		except sqlite3.OperationalError:
+			pass
+		db.close()
+
+def hash_file(filepath, fsize=None, bufsize=1024 * 1024, algo=default_hash_algo):
+	h = new_hash(algo)
 	
-	buffer_view = memoryview(buffer)
 	with open(filepath, 'rb', buffering=0) as f:
+		if fsize is not None and fsize <= bufsize:
+			h.update(f.read())
+			return h.hexdigest()
+		
+		# let the kernel read ahead while we are hashing
+		if hasattr(os, "posix_fadvise"):
+			os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+		
+		# hashlib.file_digest() is not used as it is the same readinto()
+		# loop in python with a fixed buffer size. hashlib already releases
+		# the GIL in update() for large buffers.
+		buffer = bytearray(bufsize)
+		buffer_view = memoryview(buffer)
 		while True:
 			n = f.readinto(buffer_view)
 			if not n:
@@ -35,21 +133,79 @@ def hash_file(filepath, bufsize=128 * 1024):
 			h.update(buffer_view[:n])
 	return h.hexdigest()
 
-def hash_file_partial(filepath, chunk_size=4096):
-	fsize = os.stat(filepath).st_size
-	h = hashlib.md5()
+def hash_file_partial(filepath, fsize=None, chunk_size=4096, algo=default_hash_algo, version=partial_hash_version):
+	if fsize is None:
+		fsize = os.stat(filepath).st_size
+	h = new_hash(algo)
 	
-	with open(filepath, 'rb', buffering=0) as f:
+	fd = os.open(filepath, os.O_RDONLY)
+	try:
 		if fsize <= chunk_size * 2:
-			h.update(f.read())
+			h.update(os.pread(fd, chunk_size * 2, 0))
 		else:
-			h.update(f.read(chunk_size))
-			f.seek(chunk_size, 2)
-			h.update(f.read(chunk_size))
+			# only a few bytes are read, kernel readahead would be wasted
+			if hasattr(os, "posix_fadvise"):
+				os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+			
+			h.update(os.pread(fd, chunk_size, 0))
+			if version >= 2:
+				h.update(os.pread(fd, chunk_size, fsize - chunk_size))
+	finally:
+		os.close(fd)
 	return h.hexdigest()
 
+def hash_files(files, partial_hash_size=None, algo=default_hash_algo, jobs=None, version=partial_hash_version):
+	# hash a batch of (path, size) tuples at once. If partial_hash_size is set,
+	# only the first and, starting with partial hash version 2, the last
+	# partial_hash_size bytes of each file are used.
+	if partial_hash_size:
+		hash_func = lambda job: hash_file_partial(job[0], job[1], partial_hash_size, algo=algo, version=version)
+	else:
+		hash_func = lambda job: hash_file(job[0], job[1], algo=algo)
+	
+	if jobs == 1 or len(files) < 2:
+		return [hash_func(job) for job in files]
+	
+	# hashlib releases the GIL while hashing and reading, so threads are
+	# sufficient to use multiple cores
+	with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+		return list(executor.map(hash_func, files))
+
+def walk_entries(top):
+	# like os.walk() but returns the os.DirEntry objects of directories and
+	# files which cache the result of stat() calls
+	dirs = []
+	files = []
+	try:
+		scandir_it = os.scandir(top)
+	except OSError:
+		return
+	
+	with scandir_it:
+		for entry in scandir_it:
+			try:
+				is_dir = entry.is_dir()
+			except OSError:
+				is_dir = False
+			
+			if is_dir:
+				dirs.append(entry)
+			else:
+				files.append(entry)
+	
+	yield top, dirs, files
+	
+	for entry in dirs:
+		if not entry.is_symlink():
+			yield from walk_entries(entry.path)
+
 def process_dbpath(path, gather_only=False, filelist_gen=None, new_files=None, dbs=None, cursors=None, all_files=[]):
-	if args.verbose:
+	# local copies of values that are used for every file
+	verbose = args.verbose
+	partial_hash = config["partial_hash"]
+	partial_hash_size = config["partial_hash_size"]
+	
+	if verbose:
 		print("processing DB in", path)
 	
 	path = path.rstrip("/")
@@ -63,8 +219,7 @@ def process_dbpath(path, gather_only=False, filelist_gen=None, new_files=None, d
 		print("creating", dbpath)
 	
 	if path not in dbs:
-		lite = sqlite3.connect(dbpath)
-		lite.row_factory = sqlite3.Row
+		lite = connect_db(dbpath)
 		dbs[path] = lite
 	else:
 		lite = dbs[path]
@@ -87,99 +242,159 @@ def process_dbpath(path, gather_only=False, filelist_gen=None, new_files=None, d
 		if entry["name"] == "config":
 			config_found = True
 	if not files_found:
-		cur.execute("CREATE TABLE files(filename, relpath, size, hash, parthash)")
+		cur.execute("CREATE TABLE files(filename, relpath, size, hash, parthash, mtime)")
+	else:
+		res = cur.execute("PRAGMA table_info(files)")
+		if "mtime" not in [column["name"] for column in res.fetchall()]:
+			cur.execute("ALTER TABLE files ADD COLUMN mtime")
 	if not sub_dbs_found:
 		cur.execute("CREATE TABLE sub_dbs(relpath)")
 	if not config_found:
 		cur.execute("CREATE TABLE config(key, value)")
 	
+	# relpath is not unique in databases created by older versions, hence a
+	# plain index
+	cur.execute("CREATE INDEX IF NOT EXISTS idx_files_size_parthash ON files(size, parthash)")
+	cur.execute("CREATE INDEX IF NOT EXISTS idx_files_relpath ON files(relpath)")
+	
+	hash_algo = get_config(cur, "hash_algo")
+	if hash_algo is None:
+		if files_found:
+			hash_algo = default_hash_algo
+		else:
+			hash_algo = config["hash_algo"]
+		cur.execute("INSERT INTO config VALUES ('hash_algo', ?)", (hash_algo,))
+	if verbose and hash_algo != config["hash_algo"]:
+		print("db", dbpath, "uses hash algorithm", hash_algo, "instead of", config["hash_algo"])
+	if not hash_algo_available(hash_algo):
+		sys.exit(f"error: hash algorithm {hash_algo} of db {dbpath} is not available")
+	
+	db_partial_hash_version = get_config(cur, "partial_hash_version")
+	if db_partial_hash_version is None:
+		if files_found:
+			db_partial_hash_version = 1
+		else:
+			db_partial_hash_version = partial_hash_version
+		cur.execute("INSERT INTO config VALUES ('partial_hash_version', ?)", (db_partial_hash_version,))
+	
 	root_dir = os.path.dirname(dbpath)
 
 	check_hash = False
 	
 	if filelist_gen is None:
-		filegen = os.walk(root_dir)
+		filegen = walk_entries(root_dir)
 	else:
 		filegen = filelist_gen
 	
+	# plain tuples as looking up sqlite3.Row columns by name is slow
+	res = cur.execute("SELECT relpath, size, mtime FROM files")
+	known_files = {entry[0]: (entry[1], entry[2]) for entry in res.fetchall()}
+	get_known_file = known_files.get
+	
+	# entries without mtime are all hashed again (see below), so a db that
+	# only contains such entries is migrated to the current partial hash
+	# version at the same time
+	if db_partial_hash_version < partial_hash_version and all(known_file[1] is None for known_file in known_files.values()):
+		if verbose:
+			print("migrating", dbpath, "to partial hash version", partial_hash_version)
+		db_partial_hash_version = partial_hash_version
+		cur.execute("UPDATE config SET value = ? WHERE key == 'partial_hash_version'", (db_partial_hash_version,))
+	
+	db_filenames = {args.dbfilename + suffix for suffix in db_suffixes}
+	root_dir_len = len(root_dir) + 1
+	
+	# do not add entries to the list we are iterating over
+	collect_new_files = new_files is not None and (filelist_gen is None or new_files.get(root_dir) is not filelist_gen)
+	n_files = len(filelist_gen) if filelist_gen else 0
+	
 	file_count = 0
+	hash_queue = []
 	for root, dirs, files in filegen:
-		for f in files:
-			if f == args.dbfilename:
+		for fentry in files:
+			f = fentry.name
+			if f in db_filenames:
 				continue
 			
 			file_count += 1
 			
-			fpath = root+"/"+f
-			relpath = fpath[len(root_dir)+1:]
+			fpath = fentry.path
+			relpath = fpath[root_dir_len:]
 			
-			if args.verbose > 1:
+			if verbose > 1:
 				if gather_only:
 					print("looking for", relpath, "in db", path, end="")
 				else:
 					print("hashing", relpath, end="")
 				if filelist_gen:
-					print(" [%d/%d]" %(file_count, len(filelist_gen)))
+					print(" [%d/%d]" %(file_count, n_files))
 				else:
 					print("")
 			
-			fstat = os.stat(fpath)
+			fstat = fentry.stat()
 			fsize = fstat.st_size
+			fmtime = fstat.st_mtime_ns
 			
-			res = cur.execute(f"SELECT filename, relpath, size, hash, parthash FROM files WHERE size == {fsize}")
-			entries = res.fetchall()
-			
-			skip = False
-			for entry in entries:
-				if entry[1] == relpath:
-					skip = True
-					break
-			
-			if skip:
+			# entries added by older versions have no mtime and are hashed
+			# again once to store it
+			known_file = get_known_file(relpath)
+			if known_file is not None and known_file[0] == fsize and known_file[1] == fmtime:
 				continue
 			
-			if new_files is not None and (root_dir not in new_files or new_files[root_dir] != filelist_gen):
-				if root_dir not in new_files:
-					new_files[root_dir] = []
-				new_files[root_dir].append( (root, [], [f]) )
+			if collect_new_files:
+				new_files.setdefault(root_dir, []).append( (root, [], [fentry]) )
 			
 			if gather_only:
 				continue
 			
-			if config["partial_hash"]:
-				fhash = hash_file_partial(fpath, config["partial_hash_size"])
-				fullhash = None
-				parthash = fhash
-				hid = "parthash"
-			else:
-				fhash = hash_file(fpath)
-				fullhash = fhash
-				parthash = None
-				hid = "hash"
-			
+			hash_queue.append( (f, relpath, fsize, fmtime, fpath, known_file is not None) )
+	
+	if partial_hash:
+		fhashes = hash_files([(job[4], job[2]) for job in hash_queue], partial_hash_size, algo=hash_algo, jobs=args.jobs, version=db_partial_hash_version)
+	else:
+		fhashes = hash_files([(job[4], job[2]) for job in hash_queue], algo=hash_algo, jobs=args.jobs)
+	
+	rows = []
+	changed_files = []
+	for (f, relpath, fsize, fmtime, fpath, changed), fhash in zip(hash_queue, fhashes):
+		# the unused hash is stored as the string "None" like in databases
+		# created by older versions
+		if partial_hash:
+			fullhash = "None"
+			parthash = fhash
+		else:
+			fullhash = fhash
+			parthash = "None"
+		
+		if changed:
+			print("updating", relpath, "in db", path)
+			changed_files.append( (relpath,) )
+		else:
 			print("adding", relpath, "to db", path)
-			
-			cur.execute(f"""
-				INSERT INTO files VALUES
-				("{f}", "{relpath}", {fsize}, "{fullhash}", "{parthash}")
-				""")
+		
+		rows.append( (f, relpath, fsize, fullhash, parthash, fmtime) )
+	
+	cur.executemany("DELETE FROM files WHERE relpath == ?", changed_files)
+	cur.executemany("INSERT INTO files(filename, relpath, size, hash, parthash, mtime) VALUES (?, ?, ?, ?, ?, ?)", rows)
+	
+	if hash_queue:
+		cur.execute("ANALYZE files")
 
 	lite.commit()
 	
 	res = cur.execute("SELECT relpath FROM sub_dbs")
 	entries = res.fetchall()
 
+	removed_dbs = []
 	for entry in entries:
 		if not os.path.isfile(entry[0]):
 			print("removed db", entry[0])
-			cur.execute(f"""
-				DELETE FROM sub_dbs WHERE relpath == \"{entry[0]}\"
-				""")
-			
-			lite.commit()
+			removed_dbs.append( (entry[0],) )
+	cur.executemany("DELETE FROM sub_dbs WHERE relpath == ?", removed_dbs)
 	
 	res = cur.execute("SELECT filename, relpath, size, hash FROM files")
 	entries = res.fetchall()
+	
+	removed_files = []
 
 	for entry in entries:
 		fpath = root_dir+"/"+entry[1]
@@ -190,18 +405,14 @@ def process_dbpath(path, gather_only=False, filelist_gen=None, new_files=None, d
 			if fpath.startswith(sub_db):
 				print("will remove", entry[1], "- belongs to sub DB", sub_db)
 				
-				cur.execute(f"""
-					DELETE FROM files WHERE relpath == \"{entry[1]}\"
-					""")
-				
-				lite.commit()
+				removed_files.append( (entry[1],) )
 		
 		if not os.path.isfile(fpath):
 			if path not in missing_files:
 				missing_files[path] = []
 			missing_files[path].append(entry)
 			
-			if args.verbose:
+			if verbose:
 				print("missing file", fpath)
 			
 			continue
@@ -211,6 +422,8 @@ def process_dbpath(path, gather_only=False, filelist_gen=None, new_files=None, d
 		
 		if entry[2] != fsize:
 			print("size differs", fsize, entry[2])
+	
+	cur.executemany("DELETE FROM files WHERE relpath == ?", removed_files)
 
 def open_db_tree(path):
 	path = path.rstrip("/")
@@ -224,8 +437,7 @@ def open_db_tree(path):
 		print("no db", dbpath)
 		return
 	
-	lite = sqlite3.connect(dbpath)
-	lite.row_factory = sqlite3.Row
+	lite = connect_db(dbpath, readonly=True)
 	dest_dbs[path] = lite
 	
 	cur = lite.cursor()
@@ -233,8 +445,8 @@ def open_db_tree(path):
 
 def find_dbs(path):
 	dblist=[]
-	for root, dirs, files in os.walk(path):
-		if args.dbfilename in files:
+	for root, dirs, files in walk_entries(path):
+		if any(fentry.name == args.dbfilename for fentry in files):
 			dblist.append(root)
 			continue
 	return dblist
@@ -251,8 +463,7 @@ def open_db(path):
 		print("creating", dbpath)
 	
 	if path not in dbs:
-		db = sqlite3.connect(dbpath)
-		db.row_factory = sqlite3.Row
+		db = connect_db(dbpath, readonly=True)
 	else:
 		db = dbs[path]
 	
@@ -275,21 +486,22 @@ def update_paths(paths):
 		print("gathering all files", dbpaths)
 	all_files = {}
 	file_count = 0
+	script_path = os.getcwd()+"/"+args.scriptname
 	def find_files(dbpath):
 		nonlocal file_count
-		for root, dirs, files in os.walk(dbpath):
-			if root != dbpath and args.dbfilename in files:
+		for root, dirs, files in walk_entries(dbpath):
+			if root != dbpath and any(fentry.name == args.dbfilename for fentry in files):
 				dirs[:] = []
 				find_files(root)
 				continue
-			for f in files:
-				if root+"/"+f == os.getcwd()+"/"+args.scriptname:
+			for fentry in files:
+				if fentry.path == script_path:
 					continue
 				
 				if dbpath not in all_files:
 					all_files[dbpath] = []
 				
-				all_files[dbpath].append( (root, [], [f]) )
+				all_files[dbpath].append( (root, [], [fentry]) )
 				file_count += 1
 	for dbpath in dbpaths:
 		find_files(dbpath)
@@ -322,7 +534,7 @@ def update_paths(paths):
 			found = False
 			
 			for i_dbpath in cursors:
-				res = cursors[i_dbpath].execute(f"""SELECT * FROM files WHERE size == {entry["size"]}""")
+				res = cursors[i_dbpath].execute("SELECT * FROM files WHERE size == ?", (entry["size"],))
 				i_entries = res.fetchall()
 				print("moved", dbpath+"/"+entry["relpath"], "to", [ i_entry["relpath"] for i_entry in i_entries ])
 				found = True
@@ -330,12 +542,10 @@ def update_paths(paths):
 			if not found:
 				print("removed", entry["relpath"])
 			
-			cursors[dbpath].execute(f"""
-				DELETE FROM files WHERE relpath == \"{entry[1]}\"
-				""")
+			cursors[dbpath].execute("DELETE FROM files WHERE relpath == ?", (entry[1],))
 	
 	if args.list_dups:
-		dup_hashes = []
+		dup_hashes = set()
 		for cur in cursors.values():
 			res = cur.execute("SELECT filename, relpath, size, hash, parthash FROM files")
 			entries = res.fetchall()
@@ -346,24 +556,59 @@ def update_paths(paths):
 				
 				dups = []
 				for sub_cur in cursors.values():
-					res = sub_cur.execute(f"SELECT filename, relpath, size, hash FROM files WHERE hash == '{entry[3]}'")
+					res = sub_cur.execute("SELECT filename, relpath, size, hash FROM files WHERE hash == ?", (entry[3],))
 					sub_entries = res.fetchall()
 					for sub_entry in sub_entries:
 						dups.append(sub_entry["relpath"])
 				
 				if len(dups) > 1:
-					dup_hashes.append(entry["hash"])
+					dup_hashes.add(entry["hash"])
 					print(dups)
 
 	for db in dbs.values():
 		db.commit()
 
+def collect_keys(index):
+	# create an in-memory db with the (size, parthash) pairs of an index
+	# created by index_files()
+	keys = sqlite3.connect(":memory:", uri=True)
+	keys.row_factory = sqlite3.Row
+	keys.execute("CREATE TABLE keys(size, parthash, PRIMARY KEY (size, parthash)) WITHOUT ROWID")
+	keys.executemany("INSERT INTO keys VALUES (?, ?)", index.keys())
+	# dbs cannot be attached inside a transaction
+	keys.commit()
+	
+	return keys
+
+def index_files(cursors, keys=None, entries_by_db=None):
+	# map (size, parthash) to the entries with these values in each db. If
+	# keys is set, sqlite joins the files with the keys created by
+	# collect_keys() and only matching entries are loaded. The dbs are
+	# attached one after another as sqlite limits the number of attached dbs.
+	# If entries_by_db is set, it receives the loaded entries of each db.
+	index = {}
+	for dbpath, cursor in cursors.items():
+		if keys is None:
+			res = cursor.execute("SELECT * FROM files ORDER BY rowid")
+			entries = res.fetchall()
+		else:
+			keys.execute("ATTACH DATABASE ? AS files_db", (readonly_uri(dbpath+"/"+args.dbfilename),))
+			res = keys.execute("SELECT files.* FROM files_db.files AS files JOIN keys USING (size, parthash) ORDER BY files.rowid")
+			entries = res.fetchall()
+			keys.execute("DETACH DATABASE files_db")
+		
+		if entries_by_db is not None:
+			entries_by_db[dbpath] = entries
+		
+		for entry in entries:
+			index.setdefault( (entry["size"], entry["parthash"]), {} ).setdefault(dbpath, []).append(entry)
+	return index
+
 def gen_sync_script(sources, dests):
 	dest_dbs = {}
 	dest_cursors = {}
 	
-	f = open(args.scriptname, "w")
-	f.write("#! /bin/sh -e\n\n")
+	lines = ["#! /bin/sh -e\n\n"]
 	
 	src_dbs = {}
 	src_dbpaths = []
@@ -385,46 +630,57 @@ def gen_sync_script(sources, dests):
 		db, cursor = open_db(path)
 		dst_dbs[path] = cursor
 	
-	mkdirs = []
+	algos = set()
+	versions = set()
+	for cursor in list(src_dbs.values()) + list(dst_dbs.values()):
+		algos.add(get_config(cursor, "hash_algo") or default_hash_algo)
+		versions.add(get_config(cursor, "partial_hash_version") or 1)
+	if len(algos) > 1:
+		print("warning: databases use different hash algorithms", sorted(algos), "- files will not be matched across them")
+	if len(versions) > 1:
+		print("warning: databases use different partial hash versions", sorted(versions), "- files will not be matched across them, update the older databases")
+	
+	# destination entries are only relevant if a source entry has the same
+	# size and hash
+	src_entries = {}
+	src_index = index_files(src_dbs, entries_by_db=src_entries)
+	src_keys = collect_keys(src_index)
+	dst_index = index_files(dst_dbs, src_keys)
+	src_keys.close()
+	
+	mkdirs = set()
 	transfer_bytes = 0
 	n_actions = 0
 	subdir = None
-	done = []
+	done = set()
 	for dbpath in src_dbs:
-		res = src_dbs[dbpath].execute(f"""SELECT * FROM files WHERE size > 0""")
-		entries = res.fetchall()
+		entries = [entry for entry in src_entries[dbpath] if entry["size"] > 0]
 		
 		if subdir is not None:
-			f.write("\ncd \"${OLDPWD}\" # from "+subdir+"\n")
-		f.write("OLDPWD=\"$(pwd)\"; cd \""+dbpath+"\"\n\n")
+			lines.append("\ncd \"${OLDPWD}\" # from "+subdir+"\n")
+		lines.append("OLDPWD=\"$(pwd)\"; cd \""+dbpath+"\"\n\n")
 		subdir=dbpath
 		
+		n_entries = len(entries)
 		i = -1
 		for entry in entries:
 			i += 1
 			
-			print(f"\r{i}/{len(entries)} ", end="")
+			print(f"\r{i}/{n_entries} ", end="")
 			
 			if entry["parthash"] in done:
 				continue
 			
 			found = False
 			
-			l_num = 0
-			sql_dup_entries = {}
-			for i_dbpath in src_dbs:
-				res = src_dbs[i_dbpath].execute(f"""SELECT * FROM files WHERE size == {entry["size"]} AND parthash == '{entry["parthash"]}'""")
-				sql_dup_entries[i_dbpath] = res.fetchall()
-				l_num += len(sql_dup_entries[i_dbpath])
+			# only dbs that contain at least one matching entry are included
+			sql_dup_entries = src_index.get( (entry["size"], entry["parthash"]), {} )
+			l_num = sum(len(l_entries) for l_entries in sql_dup_entries.values())
 			
-			r_num = 0
-			sql_rem_dup_entries = {}
-			for i_dbpath in dst_dbs:
-				res = dst_dbs[i_dbpath].execute(f"""SELECT * FROM files WHERE size == {entry["size"]} AND parthash == '{entry["parthash"]}'""")
-				sql_rem_dup_entries[i_dbpath] = res.fetchall()
-				r_num += len(sql_rem_dup_entries[i_dbpath])
+			sql_rem_dup_entries = dst_index.get( (entry["size"], entry["parthash"]), {} )
+			r_num = sum(len(r_entries) for r_entries in sql_rem_dup_entries.values())
 			
-			done.append(entry["parthash"])
+			done.add(entry["parthash"])
 			
 			if l_num == 1 and r_num == 1:
 				src = sql_dup_entries[list(sql_dup_entries.keys())[0]][0]
@@ -435,17 +691,17 @@ def gen_sync_script(sources, dests):
 					if not mkdir:
 						continue
 					if mkdir not in mkdirs:
-						mkdirs.append(mkdir)
-						f.write(f"""mkdir ${{MKDIRFLAGS}} -p \"{mkdir}\"\n""")
+						mkdirs.add(mkdir)
+						lines.append(f"""mkdir ${{MKDIRFLAGS}} -p \"{mkdir}\"\n""")
 					
-					f.write(f"""mv ${{MVFLAGS}} \"{dst["relpath"]}\" \"{src["relpath"]}\"\n""")
+					lines.append(f"""mv ${{MVFLAGS}} \"{dst["relpath"]}\" \"{src["relpath"]}\"\n""")
 					n_actions += 1
 				
 				continue
 			if l_num == 0:
 				import pdb; pdb.set_trace()
 			if r_num == 0:
-				f.write(f"""# missing on destination: \"{entry["relpath"]}\"\n""")
+				lines.append(f"""# missing on destination: \"{entry["relpath"]}\"\n""")
 				transfer_bytes += entry["size"]
 				continue
 			
@@ -467,59 +723,54 @@ def gen_sync_script(sources, dests):
 					
 					dup_entries[l_dbpath].append(e)
 			
+			# the first destination entry with a given relpath
+			r_by_relpath = {}
+			for r_dbpath in rem_dup_entries:
+				for r_entry in rem_dup_entries[r_dbpath]:
+					r_by_relpath.setdefault(r_entry["relpath"], r_entry)
+			
 			for l_dbpath in dup_entries:
 				for l_entry in dup_entries[l_dbpath]:
-					for r_dbpath in rem_dup_entries:
-						for r_entry in rem_dup_entries[r_dbpath]:
-							if l_entry["relpath"] == r_entry["relpath"]:
-								l_entry["matched"] = True
-								r_entry["matched"] = True
-								
-								if l_dbpath == dbpath and l_entry["relpath"] == entry["relpath"]:
-									found = True
-								break
+					r_entry = r_by_relpath.get(l_entry["relpath"])
+					if r_entry is not None:
+						l_entry["matched"] = True
+						r_entry["matched"] = True
 						
-						if l_entry.get("matched", False):
-							break
+						if l_dbpath == dbpath and l_entry["relpath"] == entry["relpath"]:
+							found = True
+			
+			# destination entries that can be moved, in the order of the dbs
+			unmatched_r = iter([r_entry for r_dbpath in rem_dup_entries for r_entry in rem_dup_entries[r_dbpath] if not r_entry.get("matched", False)])
 			
 			for l_dbpath in dup_entries:
 				for l_entry in dup_entries[l_dbpath]:
 					if l_entry.get("matched", False):
 						continue
 					
-					for r_dbpath in rem_dup_entries:
-						for r_entry in rem_dup_entries[r_dbpath]:
-							# if getattr(r_entry, "matched", False):
-							if r_entry.get("matched", False):
-								continue
-							
-							mkdir = os.path.dirname(l_entry["relpath"])
-							if mkdir not in mkdirs:
-								mkdirs.append(mkdir)
-								f.write(f"""mkdir ${{MKDIRFLAGS}} -p \"{mkdir}\"\n""")
-							
-							f.write(f"""mv ${{MVFLAGS}} \"{r_entry["relpath"]}\" \"{l_entry["relpath"]}\"\n""")
-							n_actions += 1
-							l_entry["matched"] = True
-							r_entry["matched"] = True
-							
-							if l_dbpath == dbpath and l_entry["relpath"] == entry["relpath"]:
-								found = True
-							
-							break
+					r_entry = next(unmatched_r, None)
+					if r_entry is not None:
+						mkdir = os.path.dirname(l_entry["relpath"])
+						if mkdir not in mkdirs:
+							mkdirs.add(mkdir)
+							lines.append(f"""mkdir ${{MKDIRFLAGS}} -p \"{mkdir}\"\n""")
+						
+						lines.append(f"""mv ${{MVFLAGS}} \"{r_entry["relpath"]}\" \"{l_entry["relpath"]}\"\n""")
+						n_actions += 1
+						l_entry["matched"] = True
+						r_entry["matched"] = True
 						
-						if l_entry.get("matched", False):
-							break
+						if l_dbpath == dbpath and l_entry["relpath"] == entry["relpath"]:
+							found = True
 					
 					if not l_entry.get("matched", False):
 						for r_dbpath in rem_dup_entries:
 							for r_entry in rem_dup_entries[r_dbpath]:
 								mkdir = os.path.dirname(l_entry["relpath"])
 								if mkdir not in mkdirs:
-									mkdirs.append(mkdir)
-									f.write(f"""mkdir ${{MKDIRFLAGS}} -p \"{mkdir}\"\n""")
+									mkdirs.add(mkdir)
+									lines.append(f"""mkdir ${{MKDIRFLAGS}} -p \"{mkdir}\"\n""")
 								
-								f.write(f"""cp ${{CPFLAGS}} --reflink \"{r_entry["relpath"]}\" \"{l_entry["relpath"]}\"\n""")
+								lines.append(f"""cp ${{CPFLAGS}} --reflink \"{r_entry["relpath"]}\" \"{l_entry["relpath"]}\"\n""")
 								n_actions += 1
 								l_entry["matched"] = True
 								
@@ -552,7 +803,10 @@ def gen_sync_script(sources, dests):
 				import pdb; pdb.set_trace()
 	
 	if subdir is not None:
-		f.write("cd \"${OLDPWD}\" # from "+subdir+"\n")
+		lines.append("cd \"${OLDPWD}\" # from "+subdir+"\n")
+	
+	with open(args.scriptname, "w", buffering=1 << 20) as f:
+		f.writelines(lines)
 	
 	print("\nn_actions", n_actions)
 	
@@ -573,7 +827,9 @@ if __name__ == "__main__":
 	parser.add_argument("--scriptname", default="update.sh", help="the script filename (default: update.sh)")
 	parser.add_argument("--list-dups", action="store_true", help="list duplicate files")
 	parser.add_argument("-P", "--partial-hash", action="store_true", default=True, help="only hash a number of bytes from the beginning and end of a file")
+	parser.add_argument("--hash-algo", choices=hash_algos, default=default_hash_algo, help="hash algorithm used for new databases, blake3 and xxh3 require the respective python module (default: md5)")
 	parser.add_argument("--partial-hash-size", type=int, default=4096, help="size of bytes that are used to create a hash of a file (default: 4096)")
+	parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="number of files that are hashed in parallel (default: number of CPUs)")
 	parser.add_argument("-g", "--gen-sync-script", action="store_true", help="create shell script that executes commands necessary to sync source and destination directories")
 	parser.add_argument("-s", "--source", action="append", help="one or more source directories")
 	parser.add_argument("-d", "--destination", action="append", help="one or more destination directories")
@@ -589,6 +845,13 @@ if __name__ == "__main__":
 
 	config["partial_hash"] = args.partial_hash
 	config["partial_hash_size"] = args.partial_hash_size
+	config["hash_algo"] = args.hash_algo
+	
+	if not hash_algo_available(args.hash_algo):
+		parser.error(f"hash algorithm {args.hash_algo} is not available, please install the required python module")
+	
+	if args.jobs < 1:
+		parser.error("the number of jobs has to be at least 1")
 	
 	if not args.update and not args.gen_sync_script:
 		if not args.destination:
@@ -601,17 +864,22 @@ if __name__ == "__main__":
 			if not args.source:
 				args.source = [os.getcwd()]
 	
-	if args.update:
-		update_paths(args.update)
-
-	if args.gen_sync_script:
-		if not args.source and args.destination:
-			sources = [os.getcwd()]
-		else:
-			sources = args.source
-		if args.source and not args.destination:
-			destinations = [os.getcwd()]
-		else:
-			destinations = args.destination
+	# the dbs are also closed if we abort, e.g., after an error or Ctrl-C
+	try:
+		if args.update:
+			update_paths(args.update)
 		
-		gen_sync_script(sources, destinations)
+		if args.gen_sync_script:
+			if not args.source and args.destination:
+				sources = [os.getcwd()]
+			else:
+				sources = args.source
+			if args.source and not args.destination:
+				destinations = [os.getcwd()]
+			else:
+				destinations = args.destination
+			
+			gen_sync_script(sources, destinations)
+	finally:
+		close_dbs()
+